@@ -4,10 +4,12 @@ Scrape NSAA softball class pages (A/B/C) and build data/softball.json.
 Keeps Tournament Name/Location and handles pages without <caption>.
 """
 
-import json, time, re
+import codecs, hashlib, json, os, string, sys, time, re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from lxml import etree, html as lh
 
 CLASS_URLS = {
     "A": "https://nsaa-static.s3.amazonaws.com/calculate/showclasssbA.html",
@@ -15,146 +17,270 @@ CLASS_URLS = {
     "C": "https://nsaa-static.s3.amazonaws.com/calculate/showclasssbC.html",
 }
 
+# All pages live on one S3 host; share a pooled keep-alive connection.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 OUT_PATH = Path(__file__).resolve().parents[1] / "data" / "softball.json"
 OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# Per-class {parser, etag, last_modified, by_team} from the previous run, so an
+# unchanged page costs a 304 instead of a download and re-parse.
+CACHE_DIR = OUT_PATH.parent / ".cache"
+# Cached by_team is parser output; entries written by a different version of
+# this file are ignored.
+PARSER_ID = hashlib.sha1(Path(__file__).read_bytes()).hexdigest()
+
 # Columns we preserve
-KEEP_COLS = [
+KEEP_COLS = frozenset([
     "Date", "Opponent", "Class", "W-L", "W/L", "Score",
     "Tournament Name", "Tournament Location", "Site", "Time", "Home/Away",
-]
+])
+
+# A header row has "Date" plus at least one of these
+_HEADER_OPPONENT_SET = frozenset({"Opponent", "Opponents", "Opponents:", "Tournament Name"})
+
+_RECORD_RE = re.compile(r"\s*\([^)]*\)\s*$")
+# Every byte except a-z/0-9; norm() deletes these after lowercasing.
+_NORM_DELETE = bytes(
+    b for b in range(256) if chr(b) not in string.ascii_lowercase + string.digits
+)
+_PAREN_RE = re.compile(r"\(([^)]+)\)")
+_CHARSET_RE = re.compile(r"charset\s*=\s*[\"']?([^\"';\s]+)", re.I)
 
 def clean(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").replace("\xa0", " ")).strip()
+    # str.split() collapses all Unicode whitespace, \xa0 included.
+    return " ".join(s.split()) if s else ""
 
 def strip_record(name_with_record: str) -> str:
-    return re.sub(r"\s*\([^)]*\)\s*$", "", clean(name_with_record))
+    return _RECORD_RE.sub("", clean(name_with_record))
 
 def norm(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    # Non-ASCII can never survive the filter, so drop it during encode.
+    return (s or "").lower().encode("ascii", "ignore").translate(None, _NORM_DELETE).decode("ascii")
 
 TEAM_PAT = re.compile(r"([A-Za-z][A-Za-z0-9 .@&'’/-]+)\s*\(\d+-\d+\)")
 
+# How many text-bearing preceding siblings/ancestors to look through for a
+# team heading. Empty ones (<br>, <hr>) don't count. Each text-bearing node
+# cost the old previous_element walk at least two of its 80 steps, so this
+# covers at least as much.
+TEAM_LOOKBACK = 40
+
+# Precompiled XPath lookups; lxml evaluates these in C. re:test is EXSLT,
+# which lxml backs with Python's re module.
+_XPATH_NS = {"re": "http://exslt.org/regular-expressions"}
+_PREV_EXCEL_LINK = etree.XPath(
+    "preceding::a[re:test(., 'Click Here for Excel Export', 'i')][1]", namespaces=_XPATH_NS
+)
+_ROW_CELLS = etree.XPath(".//td|.//th")
+
 def extract_team_name_for_table(table):
     """Return (team_without_record, full_text_with_record) or (None, None)."""
     # 1) <caption>Team (x-y)</caption>
-    cap = table.find("caption")
-    if cap:
-        full = clean(cap.get_text())
+    cap = table.find(".//caption")
+    if cap is not None:
+        full = clean(cap.text_content())
         return strip_record(full), full
 
-    # 2) Nearby text like "Adams Central (1-4)"
-    steps = 0
+    # 2) Nearby text like "Adams Central (1-4)", possibly split across
+    # elements ("<b>Adams Central</b> (1-4)"). Walk back through preceding
+    # siblings (up through ancestors when there are none), matching the text
+    # gathered so far, and stop at anything holding an earlier table—its
+    # opponent cells carry records too.
+    text = ""
     node = table
-    while node and steps < 80:
-        node = node.previous_element
-        steps += 1
-        if not node:
+    budget = TEAM_LOOKBACK
+    while budget:
+        prev = node.getprevious()
+        holds_table = False
+        if prev is None:
+            node = node.getparent()
+            if node is None:
+                break
+            chunk = node.text or ""
+        else:
+            node = prev
+            chunk = prev.tail or ""
+            if isinstance(prev.tag, str):
+                holds_table = prev.tag == "table" or prev.find(".//table") is not None
+                if not holds_table:
+                    chunk = prev.text_content() + chunk
+        if chunk.strip():
+            budget -= 1
+            text = chunk + text
+            m = None
+            for m in TEAM_PAT.finditer(clean(text)):
+                pass
+            if m:
+                full = m.group(0)
+                return strip_record(full), full
+        if holds_table:
             break
-        text = None
-        if hasattr(node, "get_text"):
-            text = clean(node.get_text())
-        elif isinstance(node, str):
-            text = clean(node)
-        if not text:
-            continue
-        m = TEAM_PAT.search(text)
-        if m:
-            full = m.group(0)
-            return strip_record(full), full
 
     # 3) Excel link like "Click Here for Excel Export (Adams Central)"
-    a = table.find_previous("a", string=re.compile(r"Click Here for Excel Export", re.I))
-    if a:
-        t = clean(a.get_text())
-        m = re.search(r"\(([^)]+)\)", t)
+    found = _PREV_EXCEL_LINK(table)
+    if found:
+        t = clean(found[0].text_content())
+        m = _PAREN_RE.search(t)
         if m:
             full = m.group(1)
             return strip_record(full), full
 
     return None, None
 
-def parse_class_page(html: str, cls_code: str):
-    soup = BeautifulSoup(html, "html.parser")
+def parse_class_page(html: bytes, cls_code: str, encoding: str = None):
+    # With no HTTP charset, hand lxml the raw bytes so it honours the page's
+    # own encoding declaration / <meta charset>.
+    parser = lh.HTMLParser(encoding=encoding) if encoding else None
+    tree = lh.fromstring(html, parser=parser)
     by_team = {}
+    cls_code = sys.intern(cls_code)
 
-    for table in soup.find_all("table"):
+    for table in tree.iter("table"):
         team, team_display = extract_team_name_for_table(table)
         if not team:
             continue
         key = norm(team)
+        # Rows of one table already share these objects; interning also
+        # shares them across tables that repeat a team.
+        team = sys.intern(team)
+        team_display = sys.intern(team_display)
 
-        # Find the header row
-        hdr_tr = None
-        headers = []
-        for tr in table.find_all("tr"):
-            cells = [clean(td.get_text()) for td in tr.find_all(["td", "th"])]
-            if not cells:
+        # Single pass: hunt for the header row, then treat its following
+        # siblings as data rows.
+        hdr_parent = None
+        keep_idx = []
+        rows = []
+        for tr in table.iter("tr"):
+            if hdr_parent is None:
+                cells = [clean(td.text_content()) for td in _ROW_CELLS(tr)]
+                cells_set = set(cells)
+                if "Date" in cells_set and not _HEADER_OPPONENT_SET.isdisjoint(cells_set):
+                    hdr_parent = tr.getparent()
+                    # (index, header) pairs for the columns we keep
+                    keep_idx = [(i, sys.intern(h)) for i, h in enumerate(cells) if h in KEEP_COLS]
+                continue
+            if tr.getparent() is not hdr_parent:
                 continue
-            if "Date" in cells and any(x in cells for x in ["Opponent", "Opponents", "Opponents:", "Tournament Name"]):
-                hdr_tr = tr
-                headers = cells
-                break
-        if not hdr_tr:
-            continue
 
-        rows = []
-        for tr in hdr_tr.find_next_siblings("tr"):
-            text_line = tr.get_text(" ", strip=True)
+            cells = [clean(td.text_content()) for td in _ROW_CELLS(tr)]
 
-            # End-of-table guard
-            if "Total Points:" in text_line:
+            # End-of-table guard; the label isn't always in the first cell
+            if any("Total Points:" in c for c in cells):
                 break
 
             # Many NSAA tables put an <hr> row immediately after the header.
             # Don't stop here—just skip it.
-            if tr.find("hr"):
+            if tr.find(".//hr") is not None:
                 continue
 
-            tds = tr.find_all(["td", "th"])
-            if not tds:
-                continue
-            cells = [clean(td.get_text()) for td in tds]
             if not cells:
                 continue
 
-            # Skip repeated headers and the "Opponents:" section header
+            # Skip repeated headers and the "Opponents:" section header.
+            # cells is already built, so this compare is cheaper than any
+            # pre-pass to locate the (rare) reprinted header rows.
             if cells[0] == "Date":
                 continue
             if cells[0] and cells[0].lower().startswith("opponents"):
                 continue
 
-            row = {}
-            for i in range(min(len(headers), len(cells))):
-                h = headers[i]
-                v = cells[i]
-                if h in KEEP_COLS:
-                    row[h] = v
-
+            n = len(cells)
+            row = {h: cells[i] for i, h in keep_idx if i < n}
             if not row:
                 continue
 
-            row["_team"] = team
-            row["_team_display"] = team_display
-            row["_class"] = cls_code
-            rows.append(row)
+            rows.append(dict(row, _team=team, _team_display=team_display, _class=cls_code))
 
         if rows:
             by_team.setdefault(key, []).extend(rows)
 
     return by_team
 
+def write_json_atomic(path: Path, obj):
+    """Write obj as compact JSON via a temp file + os.replace, so readers
+    never see a half-written file."""
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_cache(cls_code: str) -> dict:
+    try:
+        with (CACHE_DIR / f"{cls_code}.json").open(encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if cache.get("parser") == PARSER_ID else {}
+
+def save_cache(cls_code: str, cache: dict):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(CACHE_DIR / f"{cls_code}.json", cache)
+
+def header_charset(content_type: str):
+    """Charset declared in a Content-Type header, or None if absent/unknown."""
+    m = _CHARSET_RE.search(content_type or "")
+    if not m:
+        return None
+    try:
+        codecs.lookup(m.group(1))
+    except LookupError:
+        return None
+    return m.group(1)
+
+def fetch_html(cls_code: str, url: str):
+    """Return (html, encoding, cache); html is None when the cached parse is
+    still current, encoding is None when the response declares no charset."""
+    cache = load_cache(cls_code)
+    headers = {}
+    if "by_team" in cache:
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    r = SESSION.get(url, headers=headers, timeout=30)
+    if r.status_code == 304 and headers:
+        return None, None, cache
+    r.raise_for_status()
+    return r.content, header_charset(r.headers.get("Content-Type")), {
+        "parser": PARSER_ID,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }
+
 def main():
+    # The three pages are independent; fetch them concurrently, parse after.
+    with ThreadPoolExecutor(max_workers=len(CLASS_URLS)) as ex:
+        fetched = dict(zip(CLASS_URLS, ex.map(fetch_html, CLASS_URLS, CLASS_URLS.values())))
+
+    # Parsing is CPU-bound and each page is independent; parse the changed
+    # pages in separate processes. Each page's HTML is released as soon as
+    # its result is in.
+    stale = [cls for cls, (html, _, _) in fetched.items() if html is not None]
+    if stale:
+        with ProcessPoolExecutor(max_workers=len(stale)) as ex:
+            parsed = ex.map(
+                parse_class_page,
+                [fetched[cls][0] for cls in stale], stale, [fetched[cls][1] for cls in stale],
+            )
+            for cls, data in zip(stale, parsed):
+                cache = fetched[cls][2]
+                cache["by_team"] = data
+                save_cache(cls, cache)
+                fetched[cls] = (None, None, cache)
+
     all_teams = {}
-    for cls, url in CLASS_URLS.items():
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        data = parse_class_page(r.text, cls)
-        for k, rows in data.items():
+    for cls in CLASS_URLS:
+        _, _, cache = fetched.pop(cls)
+        for k, rows in cache.pop("by_team").items():
             all_teams.setdefault(k, []).extend(rows)
 
     payload = {"updated": int(time.time()), "by_team": all_teams}
-    OUT_PATH.write_text(json.dumps(payload, ensure_ascii=False, separators=(",", ":")))
+    write_json_atomic(OUT_PATH, payload)
     print(f"Wrote {OUT_PATH} (teams: {len(all_teams)})")
 
 if __name__ == "__main__":